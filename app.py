@@ -1,10 +1,31 @@
 import streamlit as st
 import pandas as pd
-import openpyxl
+import numpy as np
+import xlsxwriter
 import re
+import hashlib
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import NewConnectionError
 import os
+import time
 from io import BytesIO
+from itertools import islice
+from functools import partial
+
+# ── Excel reader: Rust-backed calamine when installed, pandas default otherwise ──
+try:
+    import python_calamine  # noqa: F401
+    EXCEL_ENGINE = "calamine"
+except ImportError:
+    EXCEL_ENGINE = None
+
+# ── String columns: Arrow-backed when pyarrow is installed ──
+try:
+    import pyarrow  # noqa: F401
+    STRING_DTYPE = "string[pyarrow]"
+except ImportError:
+    STRING_DTYPE = "string"
 
 # ───────────────────────── FILE PATHS ─────────────────────────
 DEFAULT_TEMPLATE = "sku-template (4).xlsx"
@@ -20,7 +41,9 @@ else:
 #
 #  HOW IT WORKS:
 #    A Google Apps Script Web App acts as a tiny API sitting in
-#    front of your sheet. It handles GET (read) and POST (write).
+#    front of your sheet. GET reads the counter, GET ?action=claim
+#    reads and advances it under a script lock (one atomic round
+#    trip), and POST writes it.
 #    Because it's deployed as "Anyone, even anonymous" it needs
 #    zero credentials — just an HTTP call.
 #
@@ -37,6 +60,21 @@ else:
 # │
 # │ function doGet(e) {
 # │   var sheet = SpreadsheetApp.openById(SHEET_ID).getSheets()[0];
+# │   if (e && e.parameter && e.parameter.action === "claim") {
+# │     var lock = LockService.getScriptLock();
+# │     lock.waitLock(10000);
+# │     try {
+# │       var cell = sheet.getRange("A1");
+# │       var claimed = cell.getValue();
+# │       cell.setValue(claimed + 1);
+# │       SpreadsheetApp.flush();
+# │       return ContentService
+# │         .createTextOutput(JSON.stringify({ batch_id: claimed, claimed: true }))
+# │         .setMimeType(ContentService.MimeType.JSON);
+# │     } finally {
+# │       lock.releaseLock();
+# │     }
+# │   }
 # │   var val = sheet.getRange("A1").getValue();
 # │   return ContentService
 # │     .createTextOutput(JSON.stringify({ batch_id: val }))
@@ -59,6 +97,9 @@ else:
 #     • Who has access: Anyone
 #  6. Click Deploy → copy the Web App URL
 #  7. Paste that URL as the value of  APPS_SCRIPT_URL  below
+#
+#  Deployments of the older script (no ?action=claim) keep working:
+#  the app sees no "claimed" flag and falls back to read + write.
 # ═══════════════════════════════════════════════════════════════
 
 APPS_SCRIPT_URL = "https://script.google.com/macros/s/AKfycbxiCe1IVsghaaFa4zJvA-YuCowvvT3JzLZag1IAp9B8MFGk6w8hI4aBpoB_WsqWkbbLPg/exec"
@@ -91,15 +132,69 @@ def _local_write(v: int):
     os.replace(tmp, _FALLBACK_FILE)
 
 # ── Google Sheets read / write via Apps Script ─────────────────
+_REMOTE_ATTEMPTS = 3
+_REMOTE_TIMEOUT = (3.05, 10)  # (connect, read) seconds
+
+def _http_session() -> requests.Session:
+    """
+    Keep-alive session reused across reruns (the script re-executes each
+    time). One per browser session: requests.Session is not thread-safe, and
+    its cookie jar picks up the Apps Script redirect cookies.
+    """
+    session = st.session_state.get("_http_session")
+    if session is None:
+        session = requests.Session()
+        # Small pool, no adapter-level retries: _with_backoff owns retrying
+        session.mount("https://", HTTPAdapter(pool_connections=2, pool_maxsize=4))
+        st.session_state["_http_session"] = session
+    return session
+
+def _never_sent(exc: Exception) -> bool:
+    """True when no connection was made (DNS failure, refused, connect timeout)."""
+    if isinstance(exc, requests.ConnectTimeout):
+        return True
+    # a reset keep-alive socket is also a ConnectionError, but the server may have run the request
+    reason = getattr(exc.args[0], "reason", None) if exc.args else None
+    return isinstance(reason, NewConnectionError)
+
+def _with_backoff(call, attempts: int = _REMOTE_ATTEMPTS):
+    """Retry `call` only while its request never reached the server."""
+    for attempt in range(attempts):
+        try:
+            return call()
+        except requests.ConnectionError as e:
+            if attempt == attempts - 1 or not _never_sent(e):
+                raise
+            time.sleep(0.25 * 2 ** attempt)
+
 def _remote_read() -> int:
-    r = requests.get(APPS_SCRIPT_URL, timeout=10)
+    r = _http_session().get(APPS_SCRIPT_URL, timeout=_REMOTE_TIMEOUT)
     r.raise_for_status()
     return int(r.json()["batch_id"])
 
 def _remote_write(next_id: int):
-    r = requests.post(APPS_SCRIPT_URL, json={"next_id": next_id}, timeout=10)
+    r = _http_session().post(APPS_SCRIPT_URL, json={"next_id": next_id}, timeout=_REMOTE_TIMEOUT)
     r.raise_for_status()
 
+def _remote_claim() -> int:
+    """
+    Claim in one locked round trip; older scripts just return the value, so
+    advance it here. Apps Script runs doGet on the first request and answers
+    with a redirect to the result. The first hop is retried only if it never
+    connected; the redirect target is fetched once.
+    """
+    session = _http_session()
+    r = _with_backoff(lambda: session.get(APPS_SCRIPT_URL, params={"action": "claim"},
+                                          timeout=_REMOTE_TIMEOUT, allow_redirects=False))
+    if r.is_redirect:
+        r = session.get(r.headers["Location"], timeout=_REMOTE_TIMEOUT)
+    r.raise_for_status()
+    data = r.json()
+    current = int(data["batch_id"])
+    if not data.get("claimed"):
+        _remote_write(current + 1)
+    return current
+
 # ── Public helpers ─────────────────────────────────────────────
 def peek_next_batch_id() -> int:
     """Read current BatchID without consuming it (for UI display)."""
@@ -112,14 +207,14 @@ def peek_next_batch_id() -> int:
 
 def get_and_increment_batch_id() -> int:
     """
-    Atomically claim the current BatchID and advance the counter.
-    Returns the claimed BatchID.
+    Claim the current BatchID and advance the counter; returns the claimed ID.
+    Atomic with a script that supports ?action=claim (LockService). Older
+    deployments fall back to read-then-POST, which is not atomic: two
+    concurrent claims can get the same ID.
     """
     if APPS_SCRIPT_URL:
         try:
-            current = _remote_read()
-            _remote_write(current + 1)
-            return current
+            return _remote_claim()
         except Exception as e:
             pass  # Silently fall back to local counter if Google Sheets is unavailable
     # Fallback
@@ -129,33 +224,56 @@ def get_and_increment_batch_id() -> int:
 
 
 # ╭───────────────── NORMALISERS & HELPERS ─────────────────╮
+_WS_RE = re.compile(r"\s+")
+_NON_ALNUM_RE = re.compile(r"[^0-9A-Za-z ]+", re.ASCII)
+
+def _is_missing(s) -> bool:
+    """Scalar NaN/None test without pd.isna's array dispatch."""
+    return s is None or s is pd.NA or s is pd.NaT or (isinstance(s, float) and s != s)
+
 def norm(s) -> str:
-    if pd.isna(s):
+    if _is_missing(s):
         return ""
-    return "".join(str(s).split()).lower()
+    return _WS_RE.sub("", str(s)).lower()
 
 def clean_header(header) -> str:
-    if pd.isna(header):
+    if _is_missing(header):
         return ""
-    header_str = str(header)
-    header_str = re.sub(r"[^0-9A-Za-z ]+", " ", header_str)
-    header_str = re.sub(r"\s+", " ", header_str).strip()
-    return header_str
+    header_str = _NON_ALNUM_RE.sub(" ", str(header))
+    return _WS_RE.sub(" ", header_str).strip()
+
+IMAGE_EXTS = (".jpg", ".jpeg", ".png", ".gif", ".bmp", ".webp", ".tif", ".tiff")
+# Field types whose Values cells are written as text ("@")
+TEXT_FIELD_TYPES = frozenset({"string", "imageurlarray"})
 
-IMAGE_EXT_RE = re.compile(r"(?i)\.(jpe?g|png|gif|bmp|webp|tiff?)$")
 IMAGE_KEYWORDS = {"image", "img", "picture", "photo", "thumbnail", "thumb", "hero", "front", "back", "url"}
+IMAGE_KEYWORD_RE = re.compile("|".join(map(re.escape, sorted(IMAGE_KEYWORDS))))
 
 def is_image_column(col_header_norm: str, series: pd.Series) -> bool:
-    header_hit = any(k in col_header_norm for k in IMAGE_KEYWORDS)
-    sample = series.dropna().astype(str).head(20)
-    ratio = sample.str.contains(IMAGE_EXT_RE).mean() if not sample.empty else 0.0
-    return header_hit or ratio >= 0.30
+    if IMAGE_KEYWORD_RE.search(col_header_norm):
+        return True
+    if pd.api.types.is_numeric_dtype(series.dtype):
+        return False  # numbers can't be image URLs
+    # First 20 non-missing raw values, without materialising dropna/astype copies
+    sample = list(islice((v for v in series.values if not _is_missing(v)), 20))
+    hits = sum(1 for v in sample if str(v).lower().endswith(IMAGE_EXTS))
+    ratio = hits / len(sample) if sample else 0.0
+    return ratio >= 0.30
+
+def column_values(series: pd.Series, as_text: bool) -> list:
+    """Column as a plain list: None for missing cells, str() for text columns."""
+    missing = series.isna().to_numpy()
+    values = series.to_numpy(dtype=object)
+    if as_text:
+        # per-cell str(): astype(str) renders typed columns (datetimes) differently
+        values = np.array([str(v) for v in values], dtype=object)
+    return np.where(missing, None, values).tolist()
 
 def dedupe_columns(columns):
     seen = {}
     result = []
     for col in columns:
-        col_str = str(col) if not pd.isna(col) else "Unnamed"
+        col_str = "Unnamed" if _is_missing(col) else str(col)
         if col_str in seen:
             seen[col_str] += 1
             result.append(f"{col_str}_{seen[col_str]}")
@@ -176,96 +294,370 @@ MARKETPLACE_ID_MAP = {
     "Meesho":   ("Product ID / Style ID", "SKU ID"),
 }
 
-def find_column_by_name_like(src_df: pd.DataFrame, name: str):
+def column_index(columns) -> dict:
+    """Stripped/normalised header lookups (first column wins), built once per frame."""
+    raw, normed, ordered = {}, {}, []
+    for c in columns:
+        n = norm(c)
+        raw.setdefault(str(c).strip(), c)
+        normed.setdefault(n, c)
+        ordered.append((c, n))
+    return {"raw": raw, "norm": normed, "ordered": ordered}
+
+def find_column_by_name_like(src_df: pd.DataFrame, name: str, index: dict = None):
     if not name:
         return None
+    if index is None:
+        index = column_index(src_df.columns)
     name = str(name).strip()
-    for c in src_df.columns:
-        if str(c).strip() == name:
-            return c
+    if name in index["raw"]:
+        return index["raw"][name]
     nname = norm(name)
-    for c in src_df.columns:
-        if norm(c) == nname:
-            return c
-    for c in src_df.columns:
-        if nname in norm(c):
-            return c
-    return None
-
-def read_input_to_df(input_file, marketplace, header_row=1, data_row=2, sheet_name=None):
-    marketplace_configs = {
-        "Amazon":   {"sheet": "Template", "header_row": 4, "data_row": 7,  "sheet_index": None},
-        "Flipkart": {"sheet": None,       "header_row": 1, "data_row": 5,  "sheet_index": 2},
-        "Myntra":   {"sheet": None,       "header_row": 3, "data_row": 4,  "sheet_index": 1},
-        "Ajio":     {"sheet": None,       "header_row": 2, "data_row": 3,  "sheet_index": 2},
-        "TataCliq": {"sheet": None,       "header_row": 4, "data_row": 6,  "sheet_index": 0},
-        "Meesho":   {"sheet": None,       "header_row": 3, "data_row": 5,  "sheet_index": 1},
-        "General":  {"sheet": None,       "header_row": header_row, "data_row": data_row, "sheet_index": 0}
-    }
-    config = marketplace_configs.get(marketplace, marketplace_configs["General"])
-
-    if marketplace == "General" and sheet_name:
-        xl = pd.ExcelFile(input_file)
-        temp_df = xl.parse(sheet_name, header=None)
-        header_idx = header_row - 1
-        data_idx = data_row - 1
-        headers = temp_df.iloc[header_idx].tolist()
-        src_df = temp_df.iloc[data_idx:].copy()
-        src_df.columns = dedupe_columns(headers)
-        src_df.reset_index(drop=True, inplace=True)
+    if nname in index["norm"]:
+        return index["norm"][nname]
+    return next((c for c, n in index["ordered"] if nname in n), None)
+
+@st.cache_data(show_spinner=False, max_entries=8)
+def _cached_sheet_names(file_hash: str, _file_bytes: bytes) -> list:
+    with pd.ExcelFile(BytesIO(_file_bytes), engine=EXCEL_ENGINE) as xl:
+        return xl.sheet_names
+
+@st.cache_data(show_spinner=False, max_entries=16)
+def _cached_sheet(file_hash: str, _file_bytes: bytes, sheet) -> pd.DataFrame:
+    with pd.ExcelFile(BytesIO(_file_bytes), engine=EXCEL_ENGINE) as xl:
+        return xl.parse(sheet, header=None)
+
+def excel_sheet_names(input_file, file_hash=None) -> list:
+    """Sheet names of an upload, read once per file contents (SHA-256)."""
+    file_bytes = upload_bytes(input_file)
+    return _cached_sheet_names(file_hash or file_digest(file_bytes), file_bytes)
+
+def read_excel_sheet(input_file, sheet, file_hash=None) -> pd.DataFrame:
+    """
+    header=None parse of one sheet, shared by the preview reruns and
+    process_file. A calamine workbook handle is not thread-safe, so
+    parsed frames are cached instead (st.cache_data hands out copies).
+    """
+    file_bytes = upload_bytes(input_file)
+    return _cached_sheet(file_hash or file_digest(file_bytes), file_bytes, sheet)
+
+def upload_bytes(input_file) -> bytes:
+    """Raw upload contents; bytes pass straight through without a copy."""
+    if isinstance(input_file, bytes):
+        return input_file
+    if hasattr(input_file, "getvalue"):
+        return input_file.getvalue()
+    input_file.seek(0)
+    return input_file.read()
+
+def file_digest(file_bytes: bytes) -> str:
+    # Not memoised (that would pin the uploads): the UI hashes once per rerun
+    # and the helpers below take the result as file_hash.
+    return hashlib.sha256(file_bytes).hexdigest()
+
+@st.cache_data(show_spinner=False, max_entries=8)
+def _cached_input_df(file_hash: str, _file_bytes: bytes, marketplace, header_row, data_row, sheet_name):
+    return _parse_input_df(_file_bytes, marketplace, header_row, data_row, sheet_name, file_hash)
+
+def read_input_to_df(input_file, marketplace, header_row=1, data_row=2, sheet_name=None, file_hash=None):
+    """
+    Source DataFrame for an upload. Cached on the file's SHA-256 plus the
+    read settings, so preview reruns and process_file share one parse;
+    st.cache_data hands each caller its own copy.
+    """
+    file_bytes = upload_bytes(input_file)
+    return _cached_input_df(file_hash or file_digest(file_bytes), file_bytes,
+                            marketplace, header_row, data_row, sheet_name)
+
+def _read_sheet(input_file, sheet, header_row, data_row, file_hash=None):
+    """header=None parse of one sheet, split into headers/data at 1-based rows."""
+    temp_df = read_excel_sheet(input_file, sheet, file_hash)
+    src_df = temp_df.iloc[data_row - 1:]
+    src_df.columns = dedupe_columns(temp_df.iloc[header_row - 1].tolist())
+    src_df.reset_index(drop=True, inplace=True)
+    return src_df
 
-    elif config["sheet"] is not None:
-        xl = pd.ExcelFile(input_file)
-        temp_df = xl.parse(config["sheet"], header=None)
-        header_idx = config["header_row"] - 1
-        data_idx = config["data_row"] - 1
-        headers = temp_df.iloc[header_idx].tolist()
-        src_df = temp_df.iloc[data_idx:].copy()
-        src_df.columns = dedupe_columns(headers)
+def _read_indexed_sheet(input_file, sheet_index, header_row, data_row, file_hash=None):
+    sheet = excel_sheet_names(input_file, file_hash)[sheet_index]
+    return _read_sheet(input_file, sheet, header_row, data_row, file_hash)
+
+def _read_meesho(input_file, sheet_index, header_row, data_row, file_hash=None):
+    # file_hash is unused: openpyxl reads the bytes directly (same signature as the other readers).
+    # Meesho files have merged cells that confuse pandas row count.
+    # Use openpyxl directly to read all rows reliably.
+    import openpyxl as _oxl
+    from io import BytesIO as _BytesIO
+    _wb = _oxl.load_workbook(_BytesIO(upload_bytes(input_file)), read_only=True, data_only=True)
+    try:
+        _ws = _wb.worksheets[sheet_index]
+        _ws.reset_dimensions()              # don't trust the stored <dimension>; read every row
+        all_rows = [list(r) for r in _ws.iter_rows(values_only=True)]
+    finally:
+        _wb.close()
+    # Pad ragged rows to the widest one, as ws.max_column did
+    width    = max(map(len, all_rows), default=0)
+    all_rows = [r + [None] * (width - len(r)) for r in all_rows]
+    headers   = all_rows[header_row - 1] if len(all_rows) >= header_row else [None] * width
+    data_rows = all_rows[data_row - 1:]
+    return pd.DataFrame(data_rows, columns=dedupe_columns(headers))
+
+def _drop_amazon_parents(src_df):
+    parentage_col = find_column_by_name_like(src_df, "Parentage Level")
+    if parentage_col:
+        before = len(src_df)
+        src_df = src_df[
+            src_df[parentage_col].astype(str).str.strip().str.lower() != "parent"
+        ].copy()
         src_df.reset_index(drop=True, inplace=True)
-        if marketplace == "Amazon":
-            parentage_col = find_column_by_name_like(src_df, "Parentage Level")
-            if parentage_col:
-                before = len(src_df)
-                src_df = src_df[
-                    src_df[parentage_col].astype(str).str.strip().str.lower() != "parent"
-                ].copy()
-                src_df.reset_index(drop=True, inplace=True)
-                after = len(src_df)
-                src_df.attrs["filtered_parent_rows"] = before - after
+        after = len(src_df)
+        src_df.attrs["filtered_parent_rows"] = before - after
+    return src_df
+
+# Fixed layouts per marketplace (1-based header/data rows); anything else
+# is read like General from the first sheet.
+MARKETPLACE_READERS = {
+    "Amazon":   partial(_read_sheet,         sheet="Template", header_row=4, data_row=7),
+    "Flipkart": partial(_read_indexed_sheet, sheet_index=2,    header_row=1, data_row=5),
+    "Myntra":   partial(_read_indexed_sheet, sheet_index=1,    header_row=3, data_row=4),
+    "Ajio":     partial(_read_indexed_sheet, sheet_index=2,    header_row=2, data_row=3),
+    "TataCliq": partial(_read_indexed_sheet, sheet_index=0,    header_row=4, data_row=6),
+    "Meesho":   partial(_read_meesho,        sheet_index=1,    header_row=3, data_row=5),
+}
+
+def _parse_input_df(input_file, marketplace, header_row=1, data_row=2, sheet_name=None, file_hash=None):
+    reader = MARKETPLACE_READERS.get(marketplace)
+    if reader is not None:
+        src_df = reader(input_file, file_hash=file_hash)
+    elif marketplace == "General" and sheet_name:
+        src_df = _read_sheet(input_file, sheet_name, header_row, data_row, file_hash)
     else:
-        if marketplace == "Meesho":
-            # Meesho files have merged cells that confuse pandas row count.
-            # Use openpyxl directly to read all rows reliably.
-            import openpyxl as _oxl
-            from io import BytesIO as _BytesIO
-            _wb = _oxl.load_workbook(input_file if not hasattr(input_file, "read") else input_file, data_only=True)
-            _ws = _wb.worksheets[config["sheet_index"]]
-            header_idx = config["header_row"]       # 1-based row number
-            data_idx   = config["data_row"]         # 1-based row number
-            # Read header row
-            headers = [_ws.cell(row=header_idx, column=c).value for c in range(1, _ws.max_column + 1)]
-            # Read data rows
-            data_rows = []
-            for r in range(data_idx, _ws.max_row + 1):
-                row_vals = [_ws.cell(row=r, column=c).value for c in range(1, _ws.max_column + 1)]
-                data_rows.append(row_vals)
-            src_df = pd.DataFrame(data_rows, columns=dedupe_columns(headers))
-            src_df.reset_index(drop=True, inplace=True)
-        else:
-            xl = pd.ExcelFile(input_file)
-            temp_df = xl.parse(xl.sheet_names[config["sheet_index"]], header=None)
-            header_idx = config["header_row"] - 1
-            data_idx = config["data_row"] - 1
-            headers = temp_df.iloc[header_idx].tolist()
-            src_df = temp_df.iloc[data_idx:].copy()
-            src_df.columns = dedupe_columns(headers)
-            src_df.reset_index(drop=True, inplace=True)
-
-    src_df.dropna(axis=1, how='all', inplace=True)
+        src_df = _read_indexed_sheet(input_file, 0, header_row, data_row, file_hash)
+    if marketplace == "Amazon":
+        src_df = _drop_amazon_parents(src_df)
+
+    # drop all-empty columns with one vectorised mask
+    src_df = src_df.iloc[:, src_df.notna().to_numpy().any(axis=0)]
     return src_df
 
 
+# ╭───────────────── TEMPLATE SNAPSHOT & STREAMING ─────────────────╮
+# Output is streamed through xlsxwriter (constant_memory), which cannot
+# open an existing file — so the template is parsed once per process and
+# replayed into each export, strictly row by row.
+XLSX_OPTIONS = {"constant_memory": True, "strings_to_numbers": False,
+                "strings_to_formulas": False, "strings_to_urls": False}
+
+_XLSX_BORDERS = {
+    "thin": 1, "medium": 2, "dashed": 3, "dotted": 4, "thick": 5, "double": 6, "hair": 7,
+    "mediumDashed": 8, "dashDot": 9, "mediumDashDot": 10, "dashDotDot": 11,
+    "mediumDashDotDot": 12, "slantDashDot": 13,
+}
+_XLSX_ALIGN  = {"left": "left", "center": "center", "right": "right", "fill": "fill",
+                "justify": "justify", "centerContinuous": "center_across", "distributed": "distributed"}
+_XLSX_VALIGN = {"top": "top", "center": "vcenter", "bottom": "bottom",
+                "justify": "vjustify", "distributed": "vdistributed"}
+_XLSX_VALIDATE = {"whole": "integer", "decimal": "decimal", "list": "list", "date": "date",
+                  "time": "time", "textLength": "length", "custom": "custom"}
+_XLSX_CRITERIA = {"between": "between", "notBetween": "not between", "equal": "==", "notEqual": "!=",
+                  "greaterThan": ">", "lessThan": "<", "greaterThanOrEqual": ">=", "lessThanOrEqual": "<="}
+
+def _rgb(color, palette):
+    if color is None:
+        return None
+    if color.type == "rgb" and isinstance(color.rgb, str):
+        return "#" + color.rgb[-6:]
+    if color.type == "indexed" and color.indexed < len(palette):
+        return "#" + palette[color.indexed][-6:]
+    return None  # theme / system colours fall back to Excel defaults
+
+def xlsx_format_props(cell, palette) -> dict:
+    """openpyxl cell style → xlsxwriter add_format() properties."""
+    if not cell.has_style:
+        return {}
+    props = {}
+    font = cell.font
+    if font.b:
+        props["bold"] = True
+    if font.i:
+        props["italic"] = True
+    if font.u:
+        props["underline"] = 1
+    if font.sz:
+        props["font_size"] = font.sz
+    if font.name:
+        props["font_name"] = font.name
+    if _rgb(font.color, palette):
+        props["font_color"] = _rgb(font.color, palette)
+    if cell.fill.fill_type == "solid" and _rgb(cell.fill.fgColor, palette):
+        props["bg_color"] = _rgb(cell.fill.fgColor, palette)
+    align = cell.alignment
+    if align.horizontal in _XLSX_ALIGN:
+        props["align"] = _XLSX_ALIGN[align.horizontal]
+    if align.vertical in _XLSX_VALIGN:
+        props["valign"] = _XLSX_VALIGN[align.vertical]
+    if align.wrap_text:
+        props["text_wrap"] = True
+    for side in ("left", "right", "top", "bottom"):
+        edge = getattr(cell.border, side)
+        if edge is not None and edge.style in _XLSX_BORDERS:
+            props[side] = _XLSX_BORDERS[edge.style]
+            if _rgb(edge.color, palette):
+                props[f"{side}_color"] = _rgb(edge.color, palette)
+    if cell.number_format != "General":
+        props["num_format"] = cell.number_format
+    return props
+
+def xlsx_validation(dv):
+    """openpyxl DataValidation → (first_row, first_col, last_row, last_col, data_validation() options)."""
+    if dv.type not in _XLSX_VALIDATE or dv.formula1 is None:
+        return None
+    opts = {"validate": _XLSX_VALIDATE[dv.type], "ignore_blank": bool(dv.allow_blank),
+            "show_input": bool(dv.showInputMessage), "show_error": bool(dv.showErrorMessage)}
+    if dv.type == "list":
+        # a quoted formula is an inline list; anything else is a range reference
+        f1 = dv.formula1
+        opts["source"] = f1.strip('"').split(",") if f1.startswith('"') else "=" + f1
+        opts["dropdown"] = not dv.showDropDown  # OOXML's showDropDown actually hides the arrow
+    elif dv.type == "custom":
+        opts["value"] = "=" + dv.formula1
+    else:
+        opts["criteria"] = _XLSX_CRITERIA[dv.operator or "between"]
+        opts["value"] = dv.formula1
+        if dv.formula2 is not None:
+            opts["maximum"] = dv.formula2
+    for key, attr in (("error_type", "errorStyle"), ("error_title", "errorTitle"), ("error_message", "error"),
+                      ("input_title", "promptTitle"), ("input_message", "prompt")):
+        if getattr(dv, attr):
+            opts[key] = getattr(dv, attr)
+    ranges = list(dv.sqref.ranges)
+    if len(ranges) > 1:
+        opts["multi_range"] = str(dv.sqref)
+    first = ranges[0]
+    return first.min_row, first.min_col, first.max_row, first.max_col, opts
+
+@st.cache_resource(show_spinner=False)
+def template_bytes(path: str) -> bytes:
+    """Raw template file for the reference download, read once per process."""
+    with open(path, "rb") as f:
+        return f.read()
+
+@st.cache_resource(show_spinner=False)
+def load_template_snapshot(path: str) -> dict:
+    """
+    Read the template once and keep what xlsxwriter needs to reproduce it:
+    sheet order, column widths and formats, row heights, gridlines, data
+    validations, hyperlinks, merged blocks and the cells (value + format
+    properties) grouped by row.
+    Styled blanks are kept too: generated headers and body values inherit them.
+    """
+    # openpyxl is only needed here and in the Meesho reader; imported on first use
+    import openpyxl
+    from openpyxl.styles.colors import COLOR_INDEX
+    wb = openpyxl.load_workbook(path)
+    palette = wb._colors or COLOR_INDEX  # custom <indexedColors> from the template, if any
+    snapshot = {"sheetnames": wb.sheetnames, "active": wb.index(wb.active)}
+    for ws in wb.worksheets:
+        merges, covered = {}, set()
+        for rng in ws.merged_cells.ranges:
+            top = ws.cell(rng.min_row, rng.min_col)
+            merges[(rng.min_row, rng.min_col)] = (rng.max_row, rng.max_col, top.value,
+                                                  xlsx_format_props(top, palette))
+            covered.update(rng.cells)
+        rows, links = {}, {}
+        for row in ws.iter_rows():
+            for cell in row:
+                if (cell.row, cell.column) in covered:
+                    continue
+                if cell.value is not None or cell.has_style:
+                    rows.setdefault(cell.row, {})[cell.column] = (cell.value, xlsx_format_props(cell, palette))
+                link = cell.hyperlink
+                if link is not None and (link.location or link.target):
+                    url = "internal:" + link.location if link.location else link.target
+                    links[(cell.row, cell.column)] = (url, link.tooltip)
+        snapshot[ws.title] = {
+            "rows": rows,
+            "merges": merges,
+            "links": links,
+            "columns": [(d.min, d.max, d.width or None, xlsx_format_props(d, palette))
+                        for d in ws.column_dimensions.values() if d.min and (d.width or d.has_style)],
+            "default_height": ws.sheet_format.defaultRowHeight,
+            "heights": {r: d.height for r, d in ws.row_dimensions.items() if d.height is not None},
+            "gridlines": ws.sheet_view.showGridLines is not False,
+            "validations": [v for v in map(xlsx_validation, ws.data_validations.dataValidation) if v],
+        }
+    return snapshot
+
+def first_empty_col(sheet, header_rows=(1,)):
+    for col_idx in range(1, 201):
+        if all(sheet["rows"].get(r, {}).get(col_idx, (None,))[0] in (None, "") for r in header_rows):
+            return col_idx
+    return max((max(cols) for cols in sheet["rows"].values()), default=0) + 1
+
+def xlsx_format(wb, cache: dict, props: dict):
+    """One shared xlsxwriter Format per distinct property set."""
+    if not props:
+        return None
+    key = tuple(sorted(props.items()))
+    if key not in cache:
+        cache[key] = wb.add_format(props)
+    return cache[key]
+
+def write_template_sheet(wb, ws, sheet, formats, body_rows=(), start_col=1, header_rows=0, body_formats=()):
+    """
+    Replay a template sheet into xlsxwriter `ws`, overlaying `body_rows`
+    (row-major, starting at row 1 / `start_col`). Rows are written strictly
+    in order. Rows after `header_rows` take the per-column `body_formats`
+    (add_format properties); template cells (headers and body) keep their own style.
+    """
+    for first, last, width, props in sheet["columns"]:
+        # openpyxl reports the stored width; set_column() would add padding
+        ws.set_column_pixels(first - 1, last - 1, round(width * 7) if width else None,
+                             xlsx_format(wb, formats, props))
+    if sheet["default_height"]:
+        ws.set_default_row(sheet["default_height"])
+    for r, height in sheet["heights"].items():
+        ws.set_row(r - 1, height)
+    if not sheet["gridlines"]:
+        ws.hide_gridlines(2)
+    for r1, c1, r2, c2, opts in sheet["validations"]:
+        ws.data_validation(r1 - 1, c1 - 1, r2 - 1, c2 - 1, opts)
+    # Merged blocks are written cell by cell as their rows come up: merge_range()
+    # pads the whole block at once, and constant_memory would then flush the
+    # rows below before their other cells are written. The range itself goes
+    # on the list merge_range() keeps for <mergeCells>.
+    merged = {}
+    for (r1, c1), (r2, c2, value, props) in sheet["merges"].items():
+        ws.merge.append([r1 - 1, c1 - 1, r2 - 1, c2 - 1])
+        for r in range(r1, r2 + 1):
+            for c in range(c1, c2 + 1):
+                merged.setdefault(r, {})[c] = (value if (r, c) == (r1, c1) else None, props)
+    n_rows = max(max(sheet["rows"], default=0), max(merged, default=0), len(body_rows))
+    for r in range(1, n_rows + 1):
+        tpl = {**sheet["rows"].get(r, {}), **merged.get(r, {})}
+        body = body_rows[r - 1] if r <= len(body_rows) else ()
+        row_formats = body_formats if r > header_rows else ()
+        overlay = {}
+        for off, v in enumerate(body):
+            if v is None:
+                continue
+            c = start_col + off
+            props = {**tpl[c][1]} if c in tpl else {}
+            if off < len(row_formats) and row_formats[off]:
+                props.update(row_formats[off])
+            overlay[c] = (v, props)
+        for c, (value, props) in tpl.items():
+            if c in overlay:
+                continue
+            if (r, c) in sheet["links"]:
+                url, tip = sheet["links"][(r, c)]
+                ws.write_url(r - 1, c - 1, url, xlsx_format(wb, formats, props), value, tip)
+            else:
+                ws.write(r - 1, c - 1, value, xlsx_format(wb, formats, props))
+        for c, (value, props) in overlay.items():
+            ws.write(r - 1, c - 1, value, xlsx_format(wb, formats, props))
+# ╰───────────────────────────────────────────────────────────╯
+
+
 def process_file(
     input_file,
     marketplace: str,
@@ -274,22 +666,27 @@ def process_file(
     general_header_row: int = 1,
     general_data_row: int = 2,
     general_sheet_name: str | None = None,
+    file_hash: str | None = None,
 ):
     src_df = read_input_to_df(
         input_file, marketplace,
         header_row=general_header_row,
         data_row=general_data_row,
-        sheet_name=general_sheet_name
+        sheet_name=general_sheet_name,
+        file_hash=file_hash,
     )
 
     # ── Claim BatchID FIRST (before any processing) ──────────────
     batch_id     = get_and_increment_batch_id()
     batch_id_str = str(batch_id)
-    num_rows     = len(src_df)
+
+    # normalise every header once; reused by all the detection passes below
+    col_index = column_index(src_df.columns)
+    norm_cols = col_index["ordered"]
 
     # auto-map every column
     columns_meta = []
-    for col in src_df.columns:
+    for col, ncol in norm_cols:
         # Meesho: column headers are in format "\n\nField Name\n\nDescription\n"
         # Split by newline, take first non-empty part as the field name
         if marketplace == "Meesho":
@@ -298,178 +695,136 @@ def process_file(
             display_col = parts[0] if parts else raw.strip()
         else:
             display_col = col
-        dtype = "imageurlarray" if is_image_column(norm(col), src_df[col]) else "string"
+        dtype = "imageurlarray" if is_image_column(ncol, src_df[col]) else "string"
         # Flipkart: rename "Brand" to "Brand Name"
         # Meesho: column header is long text starting with "Brand Name" — normalise to clean label
         out_col = col
         if marketplace == "Flipkart" and str(col).strip() == "Brand":
             out_col = "Brand Name"
-        elif marketplace == "Meesho" and norm(col).startswith("brandname"):
+        elif marketplace == "Meesho" and ncol.startswith("brandname"):
             out_col = "Brand Name"
         # Use display_col as base for out, unless already renamed (e.g. Brand)
         final_out = out_col if out_col != col else display_col
         columns_meta.append({"src": col, "out": final_out, "row3": "mandatory", "row4": dtype})
 
-    # identify color/size
-    color_cols = [col for col in src_df.columns if "color" in norm(col) or "colour" in norm(col)]
-    size_cols  = [col for col in src_df.columns if "size" in norm(col)]
-
-    option1_data = pd.Series([""] * num_rows, dtype=str)
-    option2_data = pd.Series([""] * num_rows, dtype=str)
-    if size_cols:
-        option1_data = src_df[size_cols[0]].fillna('').astype(str).str.strip()
-        if color_cols and color_cols[0] != size_cols[0]:
-            option2_data = src_df[color_cols[0]].fillna('').astype(str).str.strip()
-    elif color_cols:
-        option2_data = src_df[color_cols[0]].fillna('').astype(str).str.strip()
-
-    unique_opt1 = option1_data.replace("", pd.NA).dropna().unique().tolist()
-    unique_opt2 = option2_data.replace("", pd.NA).dropna().unique().tolist()
-
-    # load workbook
-    wb = openpyxl.load_workbook(TEMPLATE_PATH)
-    ws_vals  = wb["Values"]
-    ws_types = wb["Types"]
-
-    def first_empty_col(ws, header_rows=(1,)):
-        for col_idx in range(1, 201):
-            empty = True
-            for r in header_rows:
-                if ws.cell(row=r, column=col_idx).value not in (None, ""):
-                    empty = False
-                    break
-            if empty:
-                return col_idx
-        return ws.max_column + 1
-
-    vals_start_col  = first_empty_col(ws_vals,  header_rows=(1,))
-    types_start_col = first_empty_col(ws_types, header_rows=(1, 2, 3, 4))
-
-    # Write columns_meta
-    for idx, meta in enumerate(columns_meta):
-        vcol = vals_start_col  + idx
-        tcol = types_start_col + idx
-        header_display = clean_header(meta["out"])
-        ws_vals.cell(row=1, column=vcol, value=header_display)
-        for r_idx, value in enumerate(src_df[meta["src"]].tolist(), start=2):
-            cell = ws_vals.cell(row=r_idx, column=vcol)
-            if pd.isna(value):
-                cell.value = None
-            else:
-                if str(meta["row4"]).lower() in ("string", "imageurlarray"):
-                    cell.value = str(value)
-                    cell.number_format = "@"
-                else:
-                    cell.value = value
-        ws_types.cell(row=1, column=tcol, value=header_display)
-        ws_types.cell(row=2, column=tcol, value=header_display)
-        ws_types.cell(row=3, column=tcol, value=meta["row3"])
-        ws_types.cell(row=4, column=tcol, value=meta["row4"])
-
-    # Append Option1 & Option2
-    opt1_vcol = vals_start_col  + len(columns_meta)
-    opt2_vcol = opt1_vcol + 1
-    ws_vals.cell(row=1, column=opt1_vcol, value="Option 1")
-    ws_vals.cell(row=1, column=opt2_vcol, value="Option 2")
-    for i, v in enumerate(option1_data.tolist(), start=2):
-        ws_vals.cell(row=i, column=opt1_vcol, value=v if v else None)
-    for i, v in enumerate(option2_data.tolist(), start=2):
-        ws_vals.cell(row=i, column=opt2_vcol, value=v if v else None)
-
-    opt1_tcol = types_start_col + len(columns_meta)
-    opt2_tcol = opt1_tcol + 1
-    ws_types.cell(row=1, column=opt1_tcol, value="Option 1")
-    ws_types.cell(row=2, column=opt1_tcol, value="Option 1")
-    ws_types.cell(row=3, column=opt1_tcol, value="non mandatory")
-    ws_types.cell(row=4, column=opt1_tcol, value="select")
-    ws_types.cell(row=1, column=opt2_tcol, value="Option 2")
-    ws_types.cell(row=2, column=opt2_tcol, value="Option 2")
-    ws_types.cell(row=3, column=opt2_tcol, value="non mandatory")
-    ws_types.cell(row=4, column=opt2_tcol, value="select")
-    for i, val in enumerate(unique_opt1, start=5):
-        ws_types.cell(row=i, column=opt1_tcol, value=val)
-    for i, val in enumerate(unique_opt2, start=5):
-        ws_types.cell(row=i, column=opt2_tcol, value=val)
-
-    # Append variantId & productId
-    def append_id_columns(variant_series, product_series):
-        has_var  = variant_series is not None and variant_series.replace("", pd.NA).dropna().shape[0] > 0
-        has_prod = product_series is not None and product_series.replace("", pd.NA).dropna().shape[0] > 0
-        if not (has_var or has_prod):
-            return
-        after_written_vals  = vals_start_col  + len(columns_meta) + 2
-        after_written_types = types_start_col + len(columns_meta) + 2
-        cur_v = after_written_vals
-        cur_t = after_written_types
-        if has_var:
-            ws_vals.cell(row=1, column=cur_v, value="variantId")
-            for i, v in enumerate(variant_series.tolist(), start=2):
-                cell = ws_vals.cell(row=i, column=cur_v, value=v if v else None)
-                cell.number_format = "@"
-            ws_types.cell(row=1, column=cur_t, value="variantId")
-            ws_types.cell(row=2, column=cur_t, value="variantId")
-            ws_types.cell(row=3, column=cur_t, value="mandatory")
-            ws_types.cell(row=4, column=cur_t, value="string")
-            cur_v += 1
-            cur_t += 1
-        if has_prod:
-            ws_vals.cell(row=1, column=cur_v, value="productId")
-            for i, v in enumerate(product_series.tolist(), start=2):
-                cell = ws_vals.cell(row=i, column=cur_v, value=v if v else None)
-                cell.number_format = "@"
-            ws_types.cell(row=1, column=cur_t, value="productId")
-            ws_types.cell(row=2, column=cur_t, value="productId")
-            ws_types.cell(row=3, column=cur_t, value="mandatory")
-            ws_types.cell(row=4, column=cur_t, value="string")
+    # identify color/size: Option1 = first size column, Option2 = first
+    # colour column (if different); one scan, stopping once both are found
+    size_col = first_color = None
+    for col, ncol in norm_cols:
+        if size_col is None and "size" in ncol:
+            size_col = col
+        if first_color is None and ("color" in ncol or "colour" in ncol):
+            first_color = col
+        if size_col is not None and first_color is not None:
+            break
+    color_col = first_color if first_color != size_col else None
+
+    # both option columns are cleaned in one frame-wide pass
+    opts = pd.DataFrame(
+        {"opt1": src_df[size_col] if size_col is not None else None,
+         "opt2": src_df[color_col] if color_col is not None else None},
+        index=src_df.index,
+    ).fillna("").astype(STRING_DTYPE).apply(lambda c: c.str.strip())
+    option1_data, option2_data = opts["opt1"], opts["opt2"]
+    unique_opt1, unique_opt2 = (
+        [u for u in pd.unique(c.to_numpy(dtype=object)) if u != ""] for _, c in opts.items()
+    )
+
+    # ── Assemble output columns (Values body + Types rows 1-4) ──────
+    def text_values(series):
+        values = series.to_numpy(dtype=object)
+        return np.where(values == "", None, values).tolist()
+
+    def prepare_column(meta):
+        is_text = meta["row4"] in TEXT_FIELD_TYPES
+        return {"header": clean_header(meta["out"]), "row3": meta["row3"],
+                "row4": meta["row4"], "values": column_values(src_df[meta["src"]], is_text),
+                "number_format": "@" if is_text else None}
+
+    out_cols = [prepare_column(m) for m in columns_meta]
+
+    out_cols.append({"header": "Option 1", "row3": "non mandatory", "row4": "select",
+                     "values": text_values(option1_data), "uniques": unique_opt1})
+    out_cols.append({"header": "Option 2", "row3": "non mandatory", "row4": "select",
+                     "values": text_values(option2_data), "uniques": unique_opt2})
+
+    # variantId & productId
+    def id_columns(variant_series, product_series):
+        cols = []
+        for name, series in (("variantId", variant_series), ("productId", product_series)):
+            if series is not None and series.replace("", pd.NA).dropna().shape[0] > 0:
+                cols.append({"header": name, "row3": "mandatory", "row4": "string",
+                             "values": text_values(series), "number_format": "@"})
+        return cols
 
     if marketplace == "General":
         variant_series = None
         product_series = None
         if selected_variant_col and selected_variant_col != "(none)":
             if selected_variant_col in src_df.columns:
-                variant_series = src_df[selected_variant_col].fillna("").astype(str)
+                variant_series = src_df[selected_variant_col].fillna("").astype(STRING_DTYPE)
         if selected_product_col and selected_product_col != "(none)":
             if selected_product_col in src_df.columns:
-                product_series = src_df[selected_product_col].fillna("").astype(str)
-        append_id_columns(variant_series, product_series)
+                product_series = src_df[selected_product_col].fillna("").astype(STRING_DTYPE)
+        out_cols.extend(id_columns(variant_series, product_series))
     else:
         mapping = MARKETPLACE_ID_MAP.get(marketplace, None)
         if mapping:
             prod_src_name, var_src_name = mapping
-            prod_col = find_column_by_name_like(src_df, prod_src_name)
-            var_col  = find_column_by_name_like(src_df, var_src_name)
-            prod_series = src_df[prod_col].fillna("").astype(str) if prod_col else None
-            var_series  = src_df[var_col].fillna("").astype(str)  if var_col  else None
-            append_id_columns(var_series, prod_series)
+            prod_col = find_column_by_name_like(src_df, prod_src_name, col_index)
+            var_col  = find_column_by_name_like(src_df, var_src_name, col_index)
+            prod_series = src_df[prod_col].fillna("").astype(STRING_DTYPE) if prod_col else None
+            var_series  = src_df[var_col].fillna("").astype(STRING_DTYPE)  if var_col  else None
+            out_cols.extend(id_columns(var_series, prod_series))
 
     # ── BatchID column — only for rows that have actual data ────────
     # A row is considered "has data" if at least one cell in that row
     # (across all src_df columns) is non-null and non-empty string.
-    has_data_mask = src_df.apply(
-        lambda row: any(
-            str(v).strip() not in ("", "nan", "None")
-            for v in row
-            if v is not None and not (isinstance(v, float) and __import__("math").isnan(v))
-        ),
-        axis=1
-    )
-    bv_col = first_empty_col(ws_vals, header_rows=(1,))
-    ws_vals.cell(row=1, column=bv_col, value="BatchID")
-    for df_idx, has_data in enumerate(has_data_mask):
-        if has_data:
-            r = df_idx + 2  # +2 because row 1 is header, df is 0-indexed
-            cell = ws_vals.cell(row=r, column=bv_col, value=batch_id_str)
-            cell.number_format = "@"
-
-    bt_col = first_empty_col(ws_types, header_rows=(1, 2, 3, 4))
-    ws_types.cell(row=1, column=bt_col, value="BatchID")
-    ws_types.cell(row=2, column=bt_col, value="BatchID")
-    ws_types.cell(row=3, column=bt_col, value="non mandatory")
-    ws_types.cell(row=4, column=bt_col, value="string")
+    # Swept column by column; rows already known to have data are skipped.
+    has_data_mask = np.zeros(len(src_df), dtype=bool)
+    for col in src_df.columns:
+        todo = np.flatnonzero(~has_data_mask)
+        if not len(todo):
+            break
+        has_data_mask[todo] = [
+            not _is_missing(v) and str(v).strip() not in ("", "nan", "None")
+            for v in src_df[col].to_numpy(dtype=object)[todo]
+        ]
+    out_cols.append({"header": "BatchID", "row3": "non mandatory", "row4": "string",
+                     "values": [batch_id_str if has_data else None for has_data in has_data_mask],
+                     "number_format": "@"})
     # ─────────────────────────────────────────────────────────────
 
+    # Values: header row, then one row per src_df row
+    headers = [c["header"] for c in out_cols]
+    values_rows = [headers] + [list(r) for r in zip(*(c["values"] for c in out_cols))]
+
+    # Types: name / hint / mandatory / type, then the select options
+    uniques = [c.get("uniques", []) for c in out_cols]
+    types_rows = [headers, headers,
+                  [c["row3"] for c in out_cols],
+                  [c["row4"] for c in out_cols]]
+    for i in range(max(map(len, uniques))):
+        types_rows.append([u[i] if i < len(u) else None for u in uniques])
+
+    # ── Stream the workbook: template sheets replayed, data appended ─
+    snapshot = load_template_snapshot(TEMPLATE_PATH)
+    value_formats = [{"num_format": c["number_format"]} if c.get("number_format") else None
+                     for c in out_cols]
+    body = {
+        "Values": (values_rows, first_empty_col(snapshot["Values"], header_rows=(1,)), 1, value_formats),
+        "Types":  (types_rows,  first_empty_col(snapshot["Types"],  header_rows=(1, 2, 3, 4)), 4, ()),
+    }
     buf = BytesIO()
-    wb.save(buf)
+    wb = xlsxwriter.Workbook(buf, XLSX_OPTIONS)
+    formats = {}
+    for idx, title in enumerate(snapshot["sheetnames"]):
+        ws = wb.add_worksheet(title)
+        if idx == snapshot["active"]:
+            ws.activate()
+        rows, start_col, header_rows, fmts = body.get(title, ((), 1, 0, ()))
+        write_template_sheet(wb, ws, snapshot[title], formats, rows, start_col, header_rows, fmts)
+    wb.close()
     buf.seek(0)
     return buf, batch_id
 
@@ -494,13 +849,12 @@ st.info(f"📦 Next BatchID to be assigned: **{next_id}**")
 if os.path.exists(TEMPLATE_PATH):
     st.info(f"Using template: {os.path.basename(TEMPLATE_PATH)}")
     try:
-        with open(TEMPLATE_PATH, "rb") as f:
-            st.download_button(
-                "Download current template (for reference)",
-                data=f.read(),
-                file_name=os.path.basename(TEMPLATE_PATH),
-                mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
-            )
+        st.download_button(
+            "Download current template (for reference)",
+            data=template_bytes(TEMPLATE_PATH),
+            file_name=os.path.basename(TEMPLATE_PATH),
+            mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+        )
     except Exception:
         pass
 
@@ -533,11 +887,13 @@ selected_variant_col = "(none)"
 selected_product_col = "(none)"
 
 if input_file:
+    # read and hash the upload once; every helper below takes both directly
+    file_bytes = input_file.getvalue()
+    file_hash  = file_digest(file_bytes)
     selected_sheet = None
     if marketplace_type == "General":
         try:
-            xl     = pd.ExcelFile(input_file)
-            sheets = xl.sheet_names
+            sheets = excel_sheet_names(file_bytes, file_hash)
             selected_sheet = st.selectbox("Select sheet", sheets)
         except Exception as e:
             st.error(f"Failed to read sheets from uploaded file: {e}")
@@ -545,10 +901,11 @@ if input_file:
 
     try:
         src_df = read_input_to_df(
-            input_file, marketplace_type,
+            file_bytes, marketplace_type,
             header_row=general_header_row,
             data_row=general_data_row,
-            sheet_name=selected_sheet
+            sheet_name=selected_sheet,
+            file_hash=file_hash,
         )
     except Exception as e:
         st.error(f"Failed to parse uploaded file: {e}")
@@ -578,51 +935,57 @@ if input_file:
 
     st.markdown("---")
 
-    if marketplace_type == "General":
-        if st.button("Generate Output"):
-            with st.spinner("Processing…"):
-                try:
-                    result, assigned_batch_id = process_file(
-                        input_file, marketplace_type,
-                        selected_variant_col=selected_variant_col,
-                        selected_product_col=selected_product_col,
-                        general_header_row=general_header_row,
-                        general_data_row=general_data_row,
-                        general_sheet_name=selected_sheet,
-                    )
-                    if result:
-                        st.success(f"✅ Output Generated! — BatchID assigned: **{assigned_batch_id}**")
-                        st.download_button(
-                            "📥 Download Output",
-                            data=result,
-                            file_name=f"output_template_batch{assigned_batch_id}.xlsx",
-                            mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-                            key="download_button"
-                        )
-                except Exception as e:
-                    st.error(f"Processing failed: {e}")
-    else:
+    # The last export is kept per (upload, settings) so reruns (widget changes,
+    # the download click itself) reuse it instead of claiming a new BatchID.
+    output_key = (file_hash, marketplace_type, selected_variant_col, selected_product_col,
+                  general_header_row, general_data_row, selected_sheet)
+    generated = st.session_state.get("generated_output")
+    if generated is not None and generated["key"] != output_key:
+        generated = None
+
+    def generate_output(**kwargs):
         with st.spinner("Processing…"):
             try:
                 result, assigned_batch_id = process_file(
-                    input_file, marketplace_type,
-                    selected_variant_col=None,
-                    selected_product_col=None,
+                    file_bytes, marketplace_type,
                     general_header_row=general_header_row,
                     general_data_row=general_data_row,
-                    general_sheet_name=None,
+                    file_hash=file_hash,
+                    **kwargs,
                 )
-                if result:
-                    st.success(f"✅ Output Generated! — BatchID assigned: **{assigned_batch_id}**")
-                    st.download_button(
-                        "📥 Download Output",
-                        data=result,
-                        file_name=f"output_template_batch{assigned_batch_id}.xlsx",
-                        mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-                        key="download_button"
-                    )
             except Exception as e:
                 st.error(f"Processing failed: {e}")
+                return None
+        if not result:
+            return None
+        st.session_state["generated_output"] = {
+            "key": output_key, "data": result.getvalue(), "batch_id": assigned_batch_id,
+        }
+        return st.session_state["generated_output"]
+
+    if marketplace_type == "General":
+        if st.button("Generate Output"):
+            generated = generate_output(
+                selected_variant_col=selected_variant_col,
+                selected_product_col=selected_product_col,
+                general_sheet_name=selected_sheet,
+            )
+    elif generated is None:
+        generated = generate_output(
+            selected_variant_col=None,
+            selected_product_col=None,
+            general_sheet_name=None,
+        )
+
+    if generated:
+        st.success(f"✅ Output Generated! — BatchID assigned: **{generated['batch_id']}**")
+        st.download_button(
+            "📥 Download Output",
+            data=generated["data"],
+            file_name=f"output_template_batch{generated['batch_id']}.xlsx",
+            mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+            key="download_button"
+        )
 else:
     st.info("Upload a file to enable header-detection and column selection dropdowns (General only).")
 